@@ -2,20 +2,52 @@
 """
 PAM360 Password Sync Script
 Rotates local passwords and syncs with PAM360
-Uses only Python built-in modules (no pip install required)
+Uses only Python built-in modules (no pip install required);
+orjson is used for JSON coding when installed
 """
 
+import http.client
 import json
 import os
 import platform
-import random
+import re
 import socket
 import ssl
 import string
 import subprocess
 import sys
+import threading
+import time
 import urllib.parse
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    # Keys the script reads from responses; everything else is dropped while parsing
+    _WANT = frozenset({
+        "operation", "result", "status", "message", "Details",
+        "RESOURCE NAME", "RESOURCE ID", "RESOURCEID",
+        "ACCOUNT LIST", "ACCOUNT NAME", "ACCOUNT ID",
+    })
+
+    def _keep_wanted(pairs):
+        return {k: v for k, v in pairs if k in _WANT}
+
+    _DEC = json.JSONDecoder(object_pairs_hook=_keep_wanted)
+
+    def _loads(data):
+        # Same rules as orjson: surrounding whitespace is fine, trailing data is not
+        text = data.decode().strip()
+        obj, end = _DEC.raw_decode(text)
+        if end != len(text):
+            raise json.JSONDecodeError("Extra data", text, end)
+        return obj
+
+    def _dumps(obj):
+        return json.dumps(obj, separators=(",", ":")).encode()
 
 # =======================================================
 # 1. Configuration
@@ -25,6 +57,10 @@ PAM_URL = os.environ.get("PAM_URL", "https://10.0.0.14:8282")
 TARGET_USERS = ["root", "admin"]
 RESOURCE_GROUP_NAME = "Linux Servers"
 SHARE_USER_ID = "1"
+CACHE_FILE = os.environ.get("PAM_CACHE_FILE", "/var/cache/pam360_sync.json")
+
+_SYS = platform.system()
+_IS_DARWIN = _SYS == "Darwin"
 
 # Colors for output
 class Colors:
@@ -33,73 +69,326 @@ class Colors:
     RED = "\033[0;31m"
     NC = "\033[0m"
 
+# No color codes when output is not a terminal (cron, log files)
+if not sys.stdout.isatty():
+    Colors.GREEN = Colors.YELLOW = Colors.RED = Colors.NC = ""
+
+_PREFIX_INFO = f"{Colors.GREEN}[INFO]{Colors.NC} "
+_PREFIX_WARN = f"{Colors.YELLOW}[WARN]{Colors.NC} "
+_PREFIX_ERROR = f"{Colors.RED}[ERROR]{Colors.NC} "
+
 def log_info(msg):
-    print(f"{Colors.GREEN}[INFO]{Colors.NC} {msg}")
+    sys.stdout.write(_PREFIX_INFO + msg + "\n")
 
 def log_warn(msg):
-    print(f"{Colors.YELLOW}[WARN]{Colors.NC} {msg}")
+    sys.stdout.write(_PREFIX_WARN + msg + "\n")
 
 def log_error(msg):
-    print(f"{Colors.RED}[ERROR]{Colors.NC} {msg}")
+    sys.stdout.write(_PREFIX_ERROR + msg + "\n")
 
 # =======================================================
 # Helper Functions
 # =======================================================
+_HOSTNAME = socket.gethostname()
+
 def get_hostname():
     """Get system hostname"""
-    return socket.gethostname()
+    return _HOSTNAME
 
 def get_ip_address():
     """Get primary IP address (Mac and Linux compatible)"""
+    try:
+        ip = socket.gethostbyname(_HOSTNAME)
+        if not ip.startswith("127."):
+            return ip
+    except OSError:
+        pass
+    
+    # Hostname maps to loopback (common on Debian/Ubuntu); ask the kernel for the egress address
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(0.2)
         s.connect(("8.8.8.8", 80))
         ip = s.getsockname()[0]
         s.close()
         return ip
-    except Exception:
+    except OSError:
         return "127.0.0.1"
 
-def generate_password(length=14):
-    """Generate random password"""
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choice(chars) for _ in range(length))
+_ALPHA = (string.ascii_letters + string.digits).encode()
+_MASK = 63  # 6 bits; values >= len(_ALPHA) are rejected
 
-def api_request(method, endpoint, data=None):
-    """Make API request to PAM360"""
-    url = f"{PAM_URL}{endpoint}"
-    
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    
-    headers = {
-        "AUTHTOKEN": PAM_TOKEN,
-        "Content-Type": "application/x-www-form-urlencoded"
-    }
+def generate_passwords(users, length=14):
+    """Generate a random password per user (cryptographically secure)"""
+    raw = os.urandom(length * len(users) * 2)
+    i = 0
+    passwords = {}
+    for user in users:
+        chars = bytearray(length)
+        j = 0
+        while j < length:
+            if i == len(raw):
+                # Rejection ate more than expected; draw another batch
+                raw = os.urandom(length * 2)
+                i = 0
+            b = raw[i] & _MASK
+            i += 1
+            if b < len(_ALPHA):
+                chars[j] = _ALPHA[b]
+                j += 1
+        passwords[user] = chars.decode()
+    return passwords
+
+# Request invariants, built once at import
+_CTX = ssl.create_default_context()
+_CTX.check_hostname = False
+_CTX.verify_mode = ssl.CERT_NONE
+
+_URL = urllib.parse.urlsplit(PAM_URL)
+
+# API endpoints, prefixed with any path component of PAM_URL
+_API = _URL.path.rstrip("/") + "/restapi/json/v1"
+_EP_RESOURCES = _API + "/resources"
+_EP_RESOURCE_BY_NAME = _API + "/resources/resourcename/{name}"
+_EP_ACCOUNTS = _API + "/resources/{rid}/accounts"
+_EP_PASSWORD = _API + "/resources/{rid}/accounts/{aid}/password"
+_EP_SHARE = _API + "/resources/{rid}/share"
+
+_HEADERS = {
+    "AUTHTOKEN": PAM_TOKEN,
+    "Content-Type": "application/x-www-form-urlencoded"
+}
+
+# JSON punctuation that form decoding passes through untouched; only &, =, +, %
+# and non-printable bytes actually need escaping inside INPUT_DATA
+_JSON_SAFE = '{}[]":,'
+
+_CONNECT_TIMEOUT = 2
+_READ_TIMEOUT = 30
+_RETRY_STATUS = (502, 503, 504)
+_RETRY_METHODS = ("GET", "PUT")  # Only idempotent calls are retried on 5xx
+_MAX_RETRIES = 2
+
+class _Connection(http.client.HTTPSConnection):
+    """HTTPS connection with a short connect timeout and a longer read timeout"""
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(_READ_TIMEOUT)
+
+def _new_connection():
+    """Open a connection to the PAM360 server"""
+    return _Connection(_URL.hostname, _URL.port, context=_CTX, timeout=_CONNECT_TIMEOUT)
+
+# One keep-alive connection per thread, reused for all its API requests
+_local = threading.local()
+
+def _get_connection():
+    """Return this thread's PAM360 connection, opening it on first use"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _new_connection()
+    return conn
+
+def _failed(message):
+    """Build a PAM360-style failure result"""
+    return {"operation": {"result": {"status": "Failed", "message": message}}}
+
+def _send(method, endpoint, data=None):
+    """Send a request on this thread's connection; raises on transport errors"""
+    conn = _get_connection()
     
     body = None
     if data:
-        body = urllib.parse.urlencode({"INPUT_DATA": json.dumps(data)}).encode()
+        body = b"INPUT_DATA=" + urllib.parse.quote_from_bytes(_dumps(data), safe=_JSON_SAFE).encode()
     
-    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    reconnected = False
+    retries = 0
+    while True:
+        reused = conn.sock is not None
+        try:
+            conn.request(method, endpoint, body=body, headers=_HEADERS)
+        except (ConnectionError, ssl.SSLError):
+            # Kept-alive socket was already closed (over TLS this surfaces as SSLEOFError);
+            # nothing reached the server, so any method can be resent
+            conn.close()
+            if reconnected or not reused:
+                raise
+            reconnected = True
+            conn = _local.conn = _new_connection()
+            continue
+        except Exception:
+            conn.close()
+            raise
+        
+        try:
+            response = conn.getresponse()
+            payload = response.read()
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine):
+            # The server may have processed the request; only resend idempotent calls
+            conn.close()
+            if reconnected or method not in _RETRY_METHODS:
+                raise
+            reconnected = True
+            conn = _local.conn = _new_connection()
+            continue
+        except Exception:
+            conn.close()
+            raise
+        
+        if response.status in _RETRY_STATUS and method in _RETRY_METHODS and retries < _MAX_RETRIES:
+            time.sleep(0.25 * 2 ** retries)
+            retries += 1
+            continue
+        return response, payload
+
+def _parse(response, payload):
+    """Decode a PAM360 response body"""
+    try:
+        return _loads(payload)
+    except ValueError:
+        message = payload[:256].decode(errors="replace") or f"HTTP Error {response.status}: {response.reason}"
+        return _failed(message)
+
+def api_request(method, endpoint, data=None):
+    """Make API request to PAM360"""
+    try:
+        response, payload = _send(method, endpoint, data)
+    except Exception as e:
+        return _failed(str(e))
+    return _parse(response, payload)
+
+# Response cache for read-only lookups, persisted between runs
+_TTL_SHORT = 10  # account lists
+_TTL_LONG = 60   # resource lookups
+_STALE_MAX = 600  # Oldest entry used as a fallback when PAM360 is unreachable
+_cache_lock = threading.Lock()
+
+def _load_cache():
+    # Plain json here: the response decoder may filter keys the cache layout needs
+    try:
+        with open(CACHE_FILE, "rb") as f:
+            cache = json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _valid_entry(entry):
+    return (isinstance(entry, dict) and isinstance(entry.get("data"), dict)
+            and isinstance(entry.get("ts"), (int, float)) and not isinstance(entry["ts"], bool))
+
+def _save_cache(cache):
+    tmp = f"{CACHE_FILE}.{os.getpid()}"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(_dumps(cache))
+        os.replace(tmp, CACHE_FILE)
+    except OSError:
+        pass  # Caching is best-effort
+
+def _cache_key(endpoint):
+    # Include the server so switching PAM_URL never reuses another server's IDs
+    return f"{_URL.hostname}:{_URL.port or 443}{endpoint}"
+
+def cache_invalidate(endpoint):
+    """Drop a cached response after a change on the server"""
+    with _cache_lock:
+        cache = _load_cache()
+        if cache.pop(_cache_key(endpoint), None) is not None:
+            _save_cache(cache)
+
+def cached_get(endpoint, ttl):
+    """GET with a TTL cache; falls back to the cached copy if PAM360 is unreachable"""
+    with _cache_lock:
+        cache = _load_cache()
+    key = _cache_key(endpoint)
+    entry = cache.get(key)
+    if not _valid_entry(entry):
+        entry = None  # Malformed entries are treated as a cache miss
+    now = time.time()
+    if entry and now - entry["ts"] < ttl:
+        return entry["data"]
+    if entry and now - entry["ts"] >= _STALE_MAX:
+        entry = None  # Too old to trust, even as a fallback
     
     try:
-        with urllib.request.urlopen(req, context=ctx, timeout=30) as response:
-            return json.loads(response.read().decode())
-    except urllib.error.HTTPError as e:
-        try:
-            return json.loads(e.read().decode())
-        except:
-            return {"operation": {"result": {"status": "Failed", "message": str(e)}}}
+        response, payload = _send("GET", endpoint)
     except Exception as e:
-        return {"operation": {"result": {"status": "Failed", "message": str(e)}}}
+        if entry:
+            log_warn(f"PAM360 unreachable ({e}); using cached {endpoint}")
+            return entry["data"]
+        return _failed(str(e))
+    
+    result = _parse(response, payload)
+    if result.get("operation", {}).get("result", {}).get("status") == "Success":
+        with _cache_lock:
+            cache = _load_cache()
+            cache[key] = {"ts": now, "data": result}
+            _save_cache(cache)
+    elif entry and response.status >= 500:
+        log_warn(f"PAM360 returned HTTP {response.status}; using cached {endpoint}")
+        return entry["data"]
+    return result
+
+def get_resource_id(name):
+    """Look up a resource ID by name (None if not found)"""
+    result = cached_get(_EP_RESOURCE_BY_NAME.format(name=urllib.parse.quote(name)), _TTL_LONG)
+    return result.get("operation", {}).get("Details", {}).get("RESOURCEID")
+
+def update_password(resource_id, user, account_id, password):
+    """Reset an existing account's password in PAM360; returns True on success"""
+    log_info(f"Updating password for account '{user}' (ID: {account_id})...")
+    
+    data = {
+        "operation": {
+            "Details": {
+                "NEWPASSWORD": password,
+                "RESETTYPE": "LOCAL",
+                "REASON": "Rotated via Python Script"
+            }
+        }
+    }
+    result = api_request("PUT", _EP_PASSWORD.format(rid=resource_id, aid=account_id), data)
+    status = result.get("operation", {}).get("result", {}).get("status", "Unknown")
+    
+    if status == "Success":
+        log_info(f"Password updated for '{user}'")
+    else:
+        log_warn(f"Update result: {status}")
+    return status == "Success"
 
-def change_local_password(user, password):
-    """Change local password (Linux only)"""
-    if platform.system() == "Darwin":
-        return False
+def create_accounts(resource_id, users, user_passwords):
+    """Add several accounts to a resource in a single request; returns True on success"""
+    data = {
+        "operation": {
+            "Details": {
+                "ACCOUNTLIST": [{
+                    "ACCOUNTNAME": user,
+                    "PASSWORD": user_passwords[user],
+                    "ACCOUNTPASSWORDPOLICY": "Strong"
+                } for user in users]
+            }
+        }
+    }
+    endpoint = _EP_ACCOUNTS.format(rid=resource_id)
+    result = api_request("POST", endpoint, data)
+    status = result.get("operation", {}).get("result", {}).get("status", "Unknown")
     
+    if status == "Success":
+        cache_invalidate(endpoint)
+        log_info(f"Accounts created: {', '.join(users)}")
+    else:
+        log_warn(f"Create result: {status}")
+    return status == "Success"
+
+# PAM chpasswd applies each line on its own and names the user in failures:
+# "(user NAME) pam_chauthtok() failed" / "(line N, user NAME) password not changed"
+_CHPASSWD_PAM_USER = re.compile(r"\((?:line \d+, )?user ([^)\s,]+)\)")
+# Non-PAM chpasswd reports "line N: ..." errors and then writes nothing for anyone
+_CHPASSWD_ABORT = re.compile(r"changes ignored|line \d+: ")
+
+def change_local_passwords(pairs):
+    """Change local passwords in one chpasswd call (Linux only)"""
     try:
         proc = subprocess.Popen(
             ["chpasswd"],
@@ -107,11 +396,20 @@ def change_local_password(user, password):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
-        proc.communicate(input=f"{user}:{password}\n".encode())
-        return proc.returncode == 0
+        _, err = proc.communicate(input="".join(f"{user}:{password}\n" for user, password in pairs.items()).encode())
     except Exception as e:
-        log_error(f"Failed to change password for {user}: {e}")
-        return False
+        log_error(f"Failed to change local passwords: {e}")
+        return {user: False for user in pairs}
+    
+    if proc.returncode == 0:
+        return {user: True for user in pairs}
+    
+    # Only PAM failures can be pinned on single users; anything else means nothing was changed
+    err = err.decode(errors="replace")
+    failed = set(_CHPASSWD_PAM_USER.findall(err))
+    if not failed or _CHPASSWD_ABORT.search(err):
+        failed = set(pairs)
+    return {user: user not in failed for user in pairs}
 
 # =======================================================
 # Main Logic
@@ -119,17 +417,16 @@ def change_local_password(user, password):
 def main():
     system_name = get_hostname()
     ip_address = get_ip_address()
-    user_passwords = {}
     
     log_info(f"System: {system_name} ({ip_address})")
-    log_info(f"Platform: {platform.system()}")
+    log_info(f"Platform: {_SYS}")
     
     # =======================================================
     # 2. Generate Passwords
     # =======================================================
     log_info("Generating passwords for target users...")
+    user_passwords = generate_passwords(TARGET_USERS)
     for user in TARGET_USERS:
-        user_passwords[user] = generate_password()
         log_info(f"Generated password for {user}")
     
     # =======================================================
@@ -137,14 +434,8 @@ def main():
     # =======================================================
     log_info(f"Checking if resource '{system_name}' exists in PAM360...")
     
-    result = api_request("GET", "/restapi/json/v1/resources")
-    resources = result.get("operation", {}).get("Details", [])
-    
-    resource_id = None
-    for r in resources:
-        if r.get("RESOURCE NAME") == system_name:
-            resource_id = r.get("RESOURCE ID")
-            break
+    resource_id = get_resource_id(system_name)
+    synced_users = set()  # Users whose new password PAM360 has stored
     
     # =======================================================
     # 4. Logic Branch A: Resource Exists
@@ -152,58 +443,24 @@ def main():
     if resource_id:
         log_info(f"Resource found (ID: {resource_id}). Processing accounts...")
         
-        result = api_request("GET", f"/restapi/json/v1/resources/{resource_id}/accounts")
+        result = cached_get(_EP_ACCOUNTS.format(rid=resource_id), _TTL_SHORT)
         accounts = result.get("operation", {}).get("Details", {}).get("ACCOUNT LIST", [])
+        acct_by_name = {acc.get("ACCOUNT NAME"): acc.get("ACCOUNT ID") for acc in accounts}
         
-        for user in TARGET_USERS:
-            password = user_passwords[user]
-            
-            account_id = None
-            for acc in accounts:
-                if acc.get("ACCOUNT NAME") == user:
-                    account_id = acc.get("ACCOUNT ID")
-                    break
-            
-            if account_id:
-                log_info(f"Updating password for account '{user}' (ID: {account_id})...")
-                
-                data = {
-                    "operation": {
-                        "Details": {
-                            "NEWPASSWORD": password,
-                            "RESETTYPE": "LOCAL",
-                            "REASON": "Rotated via Python Script"
-                        }
-                    }
-                }
-                result = api_request("PUT", f"/restapi/json/v1/resources/{resource_id}/accounts/{account_id}/password", data)
-                status = result.get("operation", {}).get("result", {}).get("status", "Unknown")
-                
-                if status == "Success":
-                    log_info(f"Password updated for '{user}'")
-                else:
-                    log_warn(f"Update result: {status}")
-            else:
-                log_info(f"Account '{user}' not found. Creating...")
-                
-                data = {
-                    "operation": {
-                        "Details": {
-                            "ACCOUNTLIST": [{
-                                "ACCOUNTNAME": user,
-                                "PASSWORD": password,
-                                "ACCOUNTPASSWORDPOLICY": "Strong"
-                            }]
-                        }
-                    }
-                }
-                result = api_request("POST", f"/restapi/json/v1/resources/{resource_id}/accounts", data)
-                status = result.get("operation", {}).get("result", {}).get("status", "Unknown")
-                
-                if status == "Success":
-                    log_info(f"Account '{user}' created")
-                else:
-                    log_warn(f"Create result: {status}")
+        found_users = [user for user in TARGET_USERS if acct_by_name.get(user)]
+        missing_users = [user for user in TARGET_USERS if not acct_by_name.get(user)]
+        for user in missing_users:
+            log_info(f"Account '{user}' not found. Creating...")
+        
+        # Per-user updates and the batched create are independent; run them concurrently
+        with ThreadPoolExecutor(max_workers=max(1, len(found_users) + bool(missing_users))) as ex:
+            futures = [([user], ex.submit(update_password, resource_id, user, acct_by_name[user], user_passwords[user]))
+                       for user in found_users]
+            if missing_users:
+                futures.append((missing_users, ex.submit(create_accounts, resource_id, missing_users, user_passwords)))
+            for users, future in futures:
+                if future.result():
+                    synced_users.update(users)
     
     # =======================================================
     # 5. Logic Branch B: Resource Does Not Exist
@@ -228,12 +485,18 @@ def main():
                 }
             }
         }
-        result = api_request("POST", "/restapi/json/v1/resources", data)
+        result = api_request("POST", _EP_RESOURCES, data)
         message = result.get("operation", {}).get("result", {}).get("message", "Unknown")
         log_info(f"Resource creation: {message}")
+        if result.get("operation", {}).get("result", {}).get("status") == "Success":
+            synced_users.add(first_user)
         
-        result = api_request("GET", f"/restapi/json/v1/resources/resourcename/{system_name}")
-        resource_id = result.get("operation", {}).get("Details", {}).get("RESOURCEID")
+        # PAM360 normally returns the new ID in operation.Details.RESOURCEID;
+        # only look it up by name if the create response omits it
+        details = result.get("operation", {}).get("Details")
+        resource_id = details.get("RESOURCEID") if isinstance(details, dict) else None
+        if not resource_id:
+            resource_id = get_resource_id(system_name)
         
         if not resource_id:
             log_error("Failed to get resource ID")
@@ -241,28 +504,11 @@ def main():
         
         log_info(f"New Resource ID: {resource_id}")
         
-        for user in TARGET_USERS[1:]:
-            password = user_passwords[user]
-            log_info(f"Adding account '{user}'...")
-            
-            data = {
-                "operation": {
-                    "Details": {
-                        "ACCOUNTLIST": [{
-                            "ACCOUNTNAME": user,
-                            "PASSWORD": password,
-                            "ACCOUNTPASSWORDPOLICY": "Strong"
-                        }]
-                    }
-                }
-            }
-            result = api_request("POST", f"/restapi/json/v1/resources/{resource_id}/accounts", data)
-            status = result.get("operation", {}).get("result", {}).get("status", "Unknown")
-            
-            if status == "Success":
-                log_info(f"Account '{user}' created")
-            else:
-                log_warn(f"Create result: {status}")
+        extra_users = TARGET_USERS[1:]
+        if extra_users:
+            log_info(f"Adding accounts: {', '.join(extra_users)}...")
+            if create_accounts(resource_id, extra_users, user_passwords):
+                synced_users.update(extra_users)
     
     # =======================================================
     # 6. Share Resource (API 9.1)
@@ -278,19 +524,29 @@ def main():
                 }
             }
         }
-        result = api_request("PUT", f"/restapi/json/v1/resources/{resource_id}/share", data)
+        result = api_request("PUT", _EP_SHARE.format(rid=resource_id), data)
         message = result.get("operation", {}).get("result", {}).get("message", "Unknown")
         log_info(f"Share result: {message}")
     
     # =======================================================
     # 7. Update Local Passwords (AFTER PAM360 sync)
     # =======================================================
-    if platform.system() == "Darwin":
+    # Only rotate passwords PAM360 has stored, or they would be lost
+    synced_passwords = {user: user_passwords[user] for user in TARGET_USERS if user in synced_users}
+    if not synced_passwords:
+        log_error("No passwords were stored in PAM360; local passwords left unchanged")
+        sys.exit(1)
+    for user in TARGET_USERS:
+        if user not in synced_users:
+            log_warn(f"Skipping local password for '{user}' (not stored in PAM360)")
+    
+    if _IS_DARWIN:
         log_warn("Running on Mac - skipping local password changes (PAM360 sync only)")
     else:
         log_info("Updating local passwords...")
-        for user in TARGET_USERS:
-            if change_local_password(user, user_passwords[user]):
+        results = change_local_passwords(synced_passwords)
+        for user in synced_passwords:
+            if results[user]:
                 log_info(f"Changed local password for '{user}'")
             else:
                 log_warn(f"Could not change local password for '{user}'")